@@ -33,13 +33,24 @@ class Commander:
 
     def __default_callback__(self, **kwargs) -> None:
         """The default callback assigned to the click command."""
+        Popen(self.script_args(**kwargs), text=True)
+
+    def script_args(self, **kwargs) -> list:
+        """Builds the argument list used to run the script associated with the command.
+
+        The values are appended to the script in the order the parameters are
+        defined in the yaml file.
+
+        :return: The script followed by the values of the parameters
+        :rtype: list
+        """
         script_parms = self.script.split()
         params_in_order = [
             kwargs[value.human_readable_name.lower()]
             for value in self.parsed_yaml["params"]
         ]
 
-        Popen(script_parms + params_in_order, text=True)
+        return script_parms + params_in_order
 
     @property
     def command(self):
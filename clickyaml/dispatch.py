@@ -0,0 +1,584 @@
+"""Dispatch command invocations from a coordinator to worker processes over sockets.
+
+The coordinator and the workers exchange newline delimited JSON messages over a
+TCP socket (``address`` is a ``(host, port)`` tuple) or a Unix socket (``address``
+is a path). Every worker holds its own :py:class:`Commander <clickyaml.commander.Commander>`
+catalog and runs invocations with the same script runner as the default callback,
+so a command behaves the same whether it is run locally or remotely.
+
+The protocol is not authenticated, only use it on trusted networks.
+
+Messages sent by a worker:
+    - **hello**: ``{"type": "hello", "worker": name, "capacity": n, "commands": [...]}``
+    - **heartbeat**: ``{"type": "heartbeat"}``
+    - **output**: ``{"type": "output", "id": id, "line": line}``
+    - **result**: ``{"type": "result", "id": id, "returncode": code}``
+    - **error**: ``{"type": "error", "id": id, "message": message}``
+
+Messages sent by the coordinator:
+    - **accept**: ``{"type": "accept"}``, the reply to a hello from a registered worker
+    - **reject**: ``{"type": "reject", "message": message}``, the reply to a hello from a refused worker
+    - **invoke**: ``{"type": "invoke", "id": id, "command": name, "args": [...]}``
+"""
+
+import json
+import os
+import queue
+import socket
+import threading
+import time
+import uuid
+from collections import deque
+from dataclasses import dataclass, field
+from subprocess import PIPE, STDOUT, Popen
+from typing import Any, Iterator, Optional, Union
+
+import click
+
+_DONE = object()
+
+#: Yielded by :py:meth:`Invocation.stream` when the invocation is re-queued because
+#: its worker died. The lines before it came from the failed attempt and should be discarded.
+RESTART = object()
+
+
+def _create_socket(address) -> socket.socket:
+    family = socket.AF_UNIX if isinstance(address, (str, os.PathLike)) else socket.AF_INET
+    return socket.socket(family, socket.SOCK_STREAM)
+
+
+def _encode(message: dict) -> bytes:
+    return (json.dumps(message) + "\n").encode("utf-8")
+
+
+def _send(sock: socket.socket, lock: threading.Lock, message: dict) -> None:
+    data = _encode(message)
+    with lock:
+        sock.sendall(data)
+
+
+def _close(sock: socket.socket) -> None:
+    try:
+        sock.shutdown(socket.SHUT_RDWR)
+    except OSError:
+        pass
+    sock.close()
+
+
+@dataclass()
+class Invocation:
+    """A command invocation submitted to the :py:class:`Coordinator`.
+
+    The output of the script is streamed back from the worker and can be consumed
+    with :py:meth:`stream`. If the worker running the invocation dies, the invocation
+    is re-queued, :py:data:`RESTART` is streamed and its output starts over on the next worker.
+    """
+
+    command: str #: Name of the command to invoke.
+    args: list #: Command line arguments passed to the command.
+    id: str = field(default_factory=lambda: uuid.uuid4().hex) #: Unique id of the invocation.
+    worker: Optional[str] = field(init=False, default=None) #: Name of the worker the invocation was last sent to.
+    attempts: int = field(init=False, default=0) #: Number of times the invocation was assigned to a worker.
+    returncode: Optional[int] = field(init=False, default=None) #: Return code of the script.
+    error: Optional[str] = field(init=False, default=None) #: Error message, if the invocation could not be run.
+    _events: Any = field(init=False, repr=False, default_factory=queue.Queue)
+    _done: Any = field(init=False, repr=False, default_factory=threading.Event)
+
+    @property
+    def done(self) -> bool:
+        """Whether the invocation has finished."""
+        return self._done.is_set()
+
+    def stream(self, timeout=None) -> Iterator[Union[str, object]]:
+        """Yields the lines of output as they are received from the worker.
+
+        :py:data:`RESTART` is yielded each time the invocation is re-queued, the lines
+        yielded before it belong to the failed attempt. Each line is yielded only once, so
+        streaming a finished invocation again yields nothing.
+
+        :param timeout: Seconds to wait for each line, defaults to None
+        :type timeout: float | None, optional
+        :raises TimeoutError: Raised if no line is received within *timeout*
+        :return: An iterator over the output lines and restart markers
+        :rtype: Iterator[str | object]
+        """
+        while True:
+            try:
+                line = self._events.get(timeout=timeout)
+            except queue.Empty:
+                raise TimeoutError(f"No output from invocation {self.id}") from None
+            if line is _DONE:
+                # Leave the marker for any other or later consumer
+                self._events.put(_DONE)
+                return
+            yield line
+
+    def result(self, timeout=None) -> int:
+        """Waits for the invocation to finish and returns the return code of the script.
+
+        :param timeout: Seconds to wait, defaults to None
+        :type timeout: float | None, optional
+        :raises TimeoutError: Raised if the invocation does not finish within *timeout*
+        :raises RuntimeError: Raised if the invocation could not be run
+        :return: The return code of the script
+        :rtype: int
+        """
+        if not self._done.wait(timeout):
+            raise TimeoutError(f"Invocation {self.id} did not finish")
+        if self.error is not None:
+            raise RuntimeError(self.error)
+        return self.returncode
+
+    def _finish(self, returncode=None, error=None) -> None:
+        self.returncode = returncode
+        self.error = error
+        self._done.set()
+        self._events.put(_DONE)
+
+
+@dataclass(eq=False)
+class _WorkerConnection:
+    name: str
+    sock: socket.socket
+    capacity: int
+    commands: set
+    last_seen: float = field(default_factory=time.monotonic)
+    alive: bool = True
+    sending: dict = field(default_factory=dict)
+    inflight: dict = field(default_factory=dict)
+    outbox: Any = field(default_factory=queue.Queue)
+
+    @property
+    def running(self) -> int:
+        return len(self.sending) + len(self.inflight)
+
+    @property
+    def load(self) -> float:
+        return self.running / self.capacity
+
+
+class Coordinator:
+    """Accepts worker connections and farms out command invocations to them.
+
+    Invocations are sent to the least loaded live worker that knows the command and
+    has a free slot. Workers that close their connection, miss heartbeats for
+    *heartbeat_timeout* seconds or cannot receive an invocation within that time are
+    dropped and their invocations are re-queued, an invocation that loses its worker
+    *max_attempts* times fails instead.
+
+    :param commanders: The Commander catalog, used to validate submitted commands
+    :type commanders: dict[str, Commander]
+    :param address: Address to listen on, a ``(host, port)`` tuple or a Unix socket path,
+        defaults to ``("127.0.0.1", 0)``
+    :type address: tuple | str, optional
+    :param heartbeat_timeout: Seconds without a message after which a worker is considered dead,
+        defaults to 5.0
+    :type heartbeat_timeout: float, optional
+    :param max_attempts: Number of workers an invocation is sent to before it fails, defaults to 3
+    :type max_attempts: int, optional
+    """
+
+    def __init__(self, commanders: dict, address=("127.0.0.1", 0), heartbeat_timeout=5.0, max_attempts=3):
+        self.commanders = commanders
+        self.heartbeat_timeout = heartbeat_timeout
+        self.max_attempts = max_attempts
+        self._address = address
+        self._server = None
+        self._lock = threading.RLock()
+        self._pending = deque()
+        self._workers = {}
+        self._stopping = threading.Event()
+        self._threads = []
+
+    @property
+    def address(self):
+        """The address the coordinator is listening on, None until it is started."""
+        if self._server is None:
+            return None
+        return self._server.getsockname()
+
+    @property
+    def workers(self) -> dict:
+        """The number of in-flight invocations of each live worker.
+
+        :rtype: dict[str, int]
+        """
+        with self._lock:
+            return {name: conn.running for name, conn in self._workers.items()}
+
+    def start(self) -> None:
+        """Starts listening for workers."""
+        self._server = _create_socket(self._address)
+        if self._server.family == socket.AF_INET:
+            self._server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._server.bind(self._address)
+        self._server.listen()
+
+        for target in (self._accept_loop, self._monitor_loop):
+            thread = threading.Thread(target=target, daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def stop(self) -> None:
+        """Disconnects the workers and fails every unfinished invocation."""
+        if self._server is None:
+            return
+        self._stopping.set()
+        _close(self._server)
+        if self._server.family == socket.AF_UNIX:
+            try:
+                os.unlink(self._address)
+            except OSError:
+                pass
+
+        with self._lock:
+            unfinished = list(self._pending)
+            self._pending.clear()
+            for conn in self._workers.values():
+                conn.alive = False
+                unfinished.extend(conn.sending.values())
+                unfinished.extend(conn.inflight.values())
+                conn.outbox.put(None)
+                _close(conn.sock)
+            self._workers.clear()
+
+        for invocation in unfinished:
+            invocation._finish(error="Coordinator stopped")
+
+        for thread in self._threads:
+            thread.join()
+
+    def submit(self, command: str, args=()) -> Invocation:
+        """Queues an invocation of a command.
+
+        :param command: Name of the command
+        :type command: str
+        :param args: Command line arguments passed to the command, defaults to ()
+        :type args: list[str], optional
+        :raises ValueError: Raised if the command is not in the catalog
+        :return: The queued invocation
+        :rtype: Invocation
+        """
+        if command not in self.commanders:
+            raise ValueError(f"Unknown command '{command}'")
+
+        invocation = Invocation(command=command, args=[str(arg) for arg in args])
+        with self._lock:
+            self._pending.append(invocation)
+            self._dispatch()
+        return invocation
+
+    def _accept_loop(self) -> None:
+        while not self._stopping.is_set():
+            try:
+                sock, _ = self._server.accept()
+            except OSError:
+                return
+            thread = threading.Thread(target=self._serve_worker, args=(sock,), daemon=True)
+            thread.start()
+
+    def _monitor_loop(self) -> None:
+        while not self._stopping.wait(self.heartbeat_timeout / 4):
+            now = time.monotonic()
+            with self._lock:
+                expired = [
+                    conn
+                    for conn in self._workers.values()
+                    if now - conn.last_seen > self.heartbeat_timeout
+                ]
+                for conn in expired:
+                    self._drop(conn)
+                if expired:
+                    self._dispatch()
+
+    def _serve_worker(self, sock: socket.socket) -> None:
+        # A worker that blocks a send or stays silent for longer than the heartbeat timeout is dead
+        sock.settimeout(self.heartbeat_timeout)
+        conn = None
+        try:
+            with sock.makefile("r", encoding="utf-8") as rfile:
+                hello = json.loads(rfile.readline() or "{}")
+                if hello.get("type") != "hello":
+                    return
+                conn = _WorkerConnection(
+                    name=hello["worker"],
+                    sock=sock,
+                    capacity=max(1, int(hello.get("capacity", 1))),
+                    commands=set(hello.get("commands", ())),
+                )
+                with self._lock:
+                    if self._stopping.is_set():
+                        rejection = "Coordinator is stopping"
+                    elif conn.name in self._workers:
+                        rejection = f"A worker named '{conn.name}' is already connected"
+                    else:
+                        rejection = None
+                        self._workers[conn.name] = conn
+                        conn.outbox.put(({"type": "accept"}, None))
+                        self._dispatch()
+                if rejection is not None:
+                    sock.sendall(_encode({"type": "reject", "message": rejection}))
+                    return
+                threading.Thread(target=self._write_loop, args=(conn,), daemon=True).start()
+
+                for line in rfile:
+                    if not conn.alive:
+                        break
+                    conn.last_seen = time.monotonic()
+                    self._handle(conn, json.loads(line))
+        except (OSError, ValueError, KeyError, TypeError, AttributeError):
+            # Malformed messages drop the worker like a closed connection
+            pass
+        finally:
+            with self._lock:
+                if conn is not None and self._workers.get(conn.name) is conn:
+                    self._drop(conn)
+                    self._dispatch()
+            _close(sock)
+
+    def _write_loop(self, conn: _WorkerConnection) -> None:
+        """Sends the queued messages to a worker without holding the coordinator lock."""
+        while True:
+            item = conn.outbox.get()
+            if item is None:
+                return
+            message, invocation = item
+            try:
+                conn.sock.sendall(_encode(message))
+            except OSError:
+                with self._lock:
+                    if self._workers.get(conn.name) is conn:
+                        self._drop(conn)
+                        self._dispatch()
+                return
+            if invocation is not None:
+                with self._lock:
+                    self._sent(conn, invocation.id)
+
+    def _sent(self, conn: _WorkerConnection, invocation_id: str) -> None:
+        """Moves an invocation the worker received to in flight, must hold the lock."""
+        invocation = conn.sending.pop(invocation_id, None)
+        if invocation is not None:
+            conn.inflight[invocation_id] = invocation
+
+    def _handle(self, conn: _WorkerConnection, message: dict) -> None:
+        kind = message.get("type")
+        if kind in ("output", "result", "error"):
+            # The reply can be read before the writer thread records the send
+            with self._lock:
+                self._sent(conn, message["id"])
+        if kind == "output":
+            with self._lock:
+                invocation = conn.inflight.get(message["id"])
+                if invocation is not None:
+                    invocation._events.put(message["line"])
+        elif kind in ("result", "error"):
+            with self._lock:
+                invocation = conn.inflight.pop(message["id"], None)
+                self._dispatch()
+            if invocation is not None:
+                invocation._finish(
+                    returncode=message.get("returncode"), error=message.get("message")
+                )
+
+    def _drop(self, conn: _WorkerConnection) -> None:
+        """Removes a dead worker and re-queues its invocations, must hold the lock.
+
+        Only the invocations the worker received are marked with :py:data:`RESTART`.
+        """
+        conn.alive = False
+        self._workers.pop(conn.name, None)
+        retries = []
+        for invocation in list(conn.sending.values()) + list(conn.inflight.values()):
+            if invocation.attempts >= self.max_attempts:
+                invocation._finish(error=f"Invocation {invocation.id} lost its worker {invocation.attempts} times")
+                continue
+            if invocation.id in conn.inflight:
+                invocation._events.put(RESTART)
+            retries.append(invocation)
+        self._pending.extendleft(reversed(retries))
+        conn.sending.clear()
+        conn.inflight.clear()
+        conn.outbox.put(None)
+        _close(conn.sock)
+
+    def _dispatch(self) -> None:
+        """Queues pending invocations for the least loaded workers, must hold the lock."""
+        waiting = deque()
+        while self._pending:
+            invocation = self._pending.popleft()
+            candidates = [
+                conn
+                for conn in self._workers.values()
+                if invocation.command in conn.commands and conn.running < conn.capacity
+            ]
+            if not candidates:
+                waiting.append(invocation)
+                continue
+
+            conn = min(candidates, key=lambda conn: conn.load)
+            conn.sending[invocation.id] = invocation
+            invocation.worker = conn.name
+            invocation.attempts += 1
+            message = {
+                "type": "invoke",
+                "id": invocation.id,
+                "command": invocation.command,
+                "args": invocation.args,
+            }
+            conn.outbox.put((message, invocation))
+        self._pending = waiting
+
+
+class Worker:
+    """Connects to a :py:class:`Coordinator` and runs the invocations it receives.
+
+    Invocations are parsed by the click command of the matching Commander and run
+    with :py:meth:`Commander.script_args <clickyaml.commander.Commander.script_args>`,
+    the same as the default callback. The output of the script is streamed back to
+    the coordinator line by line.
+
+    :param commanders: The Commander catalog
+    :type commanders: dict[str, Commander]
+    :param address: Address of the coordinator, a ``(host, port)`` tuple or a Unix socket path
+    :type address: tuple | str
+    :param name: Name of the worker, defaults to a random name
+    :type name: str | None, optional
+    :param capacity: Number of invocations the worker runs at once, defaults to 1
+    :type capacity: int, optional
+    :param heartbeat_interval: Seconds between heartbeats, defaults to 1.0
+    :type heartbeat_interval: float, optional
+    """
+
+    def __init__(self, commanders: dict, address, name=None, capacity=1, heartbeat_interval=1.0):
+        self.commanders = commanders
+        self.address = address
+        self.name = name or uuid.uuid4().hex
+        self.capacity = capacity
+        self.heartbeat_interval = heartbeat_interval
+        self._sock = None
+        self._rfile = None
+        self._lock = threading.Lock()
+        self._stopping = threading.Event()
+        self._processes = set()
+        self._reader = None
+
+    def start(self) -> None:
+        """Connects to the coordinator and starts serving invocations in the background.
+
+        :raises ConnectionError: Raised if the coordinator rejects the worker
+        """
+        self._sock = _create_socket(self.address)
+        self._sock.connect(self.address)
+        self._rfile = self._sock.makefile("r", encoding="utf-8")
+        _send(
+            self._sock,
+            self._lock,
+            {
+                "type": "hello",
+                "worker": self.name,
+                "capacity": self.capacity,
+                "commands": list(self.commanders),
+            },
+        )
+
+        try:
+            reply = json.loads(self._rfile.readline())
+            accepted = reply.get("type") == "accept"
+        except (ValueError, AttributeError):
+            reply, accepted = {}, False
+        if not accepted:
+            self._rfile.close()
+            self.stop()
+            raise ConnectionError(reply.get("message", "Coordinator did not accept the worker"))
+
+        self._reader = threading.Thread(target=self._read_loop, daemon=True)
+        self._reader.start()
+        threading.Thread(target=self._heartbeat_loop, daemon=True).start()
+
+    def serve_forever(self) -> None:
+        """Connects to the coordinator and serves invocations until the connection is closed."""
+        self.start()
+        self._reader.join()
+
+    def stop(self) -> None:
+        """Disconnects from the coordinator and terminates the running scripts."""
+        self._stopping.set()
+        if self._sock is not None:
+            _close(self._sock)
+        for process in list(self._processes):
+            process.terminate()
+
+    def _read_loop(self) -> None:
+        try:
+            with self._rfile as rfile:
+                for line in rfile:
+                    message = json.loads(line)
+                    if message.get("type") == "invoke":
+                        args = (str(message["id"]), str(message["command"]), [str(arg) for arg in message["args"]])
+                        threading.Thread(target=self._run, args=args, daemon=True).start()
+        except (OSError, ValueError, KeyError, TypeError, AttributeError):
+            pass
+        finally:
+            self.stop()
+
+    def _heartbeat_loop(self) -> None:
+        while not self._stopping.wait(self.heartbeat_interval):
+            try:
+                _send(self._sock, self._lock, {"type": "heartbeat"})
+            except OSError:
+                return
+
+    def _run(self, invocation_id: str, command: str, args: list) -> None:
+        prepared = self._prepare(invocation_id, command, args)
+        try:
+            if isinstance(prepared, Popen):
+                reply = self._stream_process(invocation_id, prepared)
+            else:
+                output, reply = prepared
+                for line in output:
+                    _send(self._sock, self._lock, {"type": "output", "id": invocation_id, "line": line})
+            _send(self._sock, self._lock, reply)
+        except OSError:
+            pass
+
+    def _prepare(self, invocation_id: str, command: str, args: list):
+        """Parses the arguments and starts the script of an invocation.
+
+        :return: The process running the script, or the output lines and the reply
+            if the script is not run
+        :rtype: Popen | tuple[list[str], dict]
+        """
+        try:
+            cmdr = self.commanders.get(command)
+            if cmdr is None:
+                raise ValueError(f"Unknown command '{command}'")
+            help_ctx = click.Context(cmdr.command, info_name=command)
+            help_option = cmdr.command.get_help_option(help_ctx)
+            options = args[: args.index("--")] if "--" in args else args
+            if help_option is not None and set(help_option.opts) & set(options):
+                # click would print the help to the worker's stdout, send it back instead
+                output = [line + "\n" for line in cmdr.command.get_help(help_ctx).splitlines()]
+                return output, {"type": "result", "id": invocation_id, "returncode": 0}
+            with cmdr.command.make_context(command, args) as ctx:
+                return Popen(cmdr.script_args(**ctx.params), stdout=PIPE, stderr=STDOUT, text=True)
+        except click.exceptions.Exit as exc:
+            return [], {"type": "result", "id": invocation_id, "returncode": exc.exit_code}
+        except click.ClickException as exc:
+            return [], {"type": "error", "id": invocation_id, "message": exc.format_message()}
+        except Exception as exc:
+            return [], {"type": "error", "id": invocation_id, "message": str(exc)}
+
+    def _stream_process(self, invocation_id: str, process: Popen) -> dict:
+        """Streams the output of a script and returns the reply with its return code."""
+        self._processes.add(process)
+        try:
+            for line in process.stdout:
+                _send(self._sock, self._lock, {"type": "output", "id": invocation_id, "line": line})
+            return {"type": "result", "id": invocation_id, "returncode": process.wait()}
+        except OSError:
+            process.terminate()
+            raise
+        finally:
+            process.stdout.close()
+            self._processes.discard(process)
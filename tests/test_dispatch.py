@@ -0,0 +1,301 @@
+"""Tests for `clickyaml.dispatch` module."""
+
+import json
+import socket
+import threading
+import time
+
+import pytest
+
+from clickyaml import clickyaml
+from clickyaml.dispatch import RESTART, Coordinator, Worker
+
+
+@pytest.fixture
+def commanders():
+    yaml_str = """
+    echocommand:
+        script: "echo"
+        params:
+            - !arg
+                param_decls: [first]
+            - !opt
+                param_decls: ["--second"]
+                default: "default"
+
+    shellcommand:
+        script: "sh -c"
+        params:
+            - !arg
+                param_decls: [code]
+
+    sleepcommand:
+        script: "sleep"
+        params:
+            - !arg
+                param_decls: [seconds]
+    """
+
+    return clickyaml.get_commanders(yaml_str)
+
+
+@pytest.fixture
+def coordinator(commanders):
+    coordinator = Coordinator(commanders, heartbeat_timeout=1.0)
+    coordinator.start()
+    yield coordinator
+    coordinator.stop()
+
+
+def start_worker(commanders, address, **kwargs):
+    kwargs.setdefault("heartbeat_interval", 0.1)
+    worker = Worker(commanders, address, **kwargs)
+    worker.start()
+    return worker
+
+
+def wait_for(condition, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+
+
+def test_run_streams_output(commanders, coordinator):
+
+    worker = start_worker(commanders, coordinator.address, name="worker")
+    try:
+        invocation = coordinator.submit("echocommand", ["arg", "--second=opt"])
+
+        assert list(invocation.stream(timeout=5)) == ["arg opt\n"]
+        assert invocation.result(timeout=5) == 0
+        assert invocation.worker == "worker"
+        assert invocation.attempts == 1
+        assert list(invocation.stream()) == []
+    finally:
+        worker.stop()
+
+
+def test_stop_before_start(commanders):
+
+    coordinator = Coordinator(commanders)
+
+    assert coordinator.address is None
+    coordinator.stop()
+
+
+def test_unix_socket(commanders, tmp_path):
+
+    coordinator = Coordinator(commanders, address=str(tmp_path / "clickyaml.sock"))
+    coordinator.start()
+    worker = start_worker(commanders, coordinator.address)
+    try:
+        invocation = coordinator.submit("echocommand", ["arg"])
+
+        assert invocation.result(timeout=5) == 0
+        assert list(invocation.stream(timeout=5)) == ["arg default\n"]
+    finally:
+        worker.stop()
+        coordinator.stop()
+
+
+def test_errors(commanders, coordinator):
+
+    with pytest.raises(ValueError):
+        coordinator.submit("unknowncommand")
+
+    worker = start_worker(commanders, coordinator.address)
+    try:
+        invocation = coordinator.submit("echocommand", ["arg", "--unknown"])
+
+        with pytest.raises(RuntimeError, match="--unknown"):
+            invocation.result(timeout=5)
+    finally:
+        worker.stop()
+
+
+def test_help(commanders, coordinator):
+
+    worker = start_worker(commanders, coordinator.address)
+    try:
+        invocation = coordinator.submit("echocommand", ["--help"])
+
+        output = "".join(invocation.stream(timeout=5))
+        assert output.startswith("Usage: echocommand [OPTIONS] FIRST")
+        assert "--second TEXT" in output
+        assert invocation.result(timeout=5) == 0
+    finally:
+        worker.stop()
+
+
+def test_duplicate_worker_name_is_rejected(commanders, coordinator):
+
+    worker = start_worker(commanders, coordinator.address, name="twin")
+    try:
+        with pytest.raises(ConnectionError, match="'twin' is already connected"):
+            start_worker(commanders, coordinator.address, name="twin")
+        assert list(coordinator.workers) == ["twin"]
+    finally:
+        worker.stop()
+
+
+def test_load_aware_scheduling(commanders, coordinator):
+
+    first = start_worker(commanders, coordinator.address, name="first", capacity=2)
+    second = start_worker(commanders, coordinator.address, name="second", capacity=1)
+    try:
+        wait_for(lambda: len(coordinator.workers) == 2)
+
+        invocations = [coordinator.submit("sleepcommand", ["0.5"]) for _ in range(4)]
+
+        assert sorted(invocation.worker for invocation in invocations[:3]) == ["first", "first", "second"]
+        assert invocations[3].worker is None
+
+        for invocation in invocations:
+            assert invocation.result(timeout=5) == 0
+    finally:
+        first.stop()
+        second.stop()
+
+
+def test_requeue_on_worker_death(commanders, coordinator):
+
+    dying = start_worker(commanders, coordinator.address, name="dying")
+    surviving = None
+    try:
+        wait_for(lambda: "dying" in coordinator.workers)
+        invocation = coordinator.submit("sleepcommand", ["0.2"])
+        assert invocation.worker == "dying"
+
+        dying.stop()
+        wait_for(lambda: "dying" not in coordinator.workers)
+
+        surviving = start_worker(commanders, coordinator.address, name="surviving")
+        assert invocation.result(timeout=5) == 0
+        assert invocation.worker == "surviving"
+        assert invocation.attempts == 2
+    finally:
+        dying.stop()
+        if surviving:
+            surviving.stop()
+
+
+def test_requeue_marks_restart_in_output(commanders, coordinator):
+
+    dying = start_worker(commanders, coordinator.address, name="dying")
+    surviving = None
+    try:
+        invocation = coordinator.submit("shellcommand", ["echo first; sleep 0.5; echo second"])
+        lines = invocation.stream(timeout=5)
+        assert next(lines) == "first\n"
+
+        dying.stop()
+        wait_for(lambda: "dying" not in coordinator.workers)
+
+        surviving = start_worker(commanders, coordinator.address, name="surviving")
+        assert list(lines) == [RESTART, "first\n", "second\n"]
+        assert invocation.result(timeout=5) == 0
+    finally:
+        dying.stop()
+        if surviving:
+            surviving.stop()
+
+
+def test_max_attempts(commanders):
+
+    coordinator = Coordinator(commanders, max_attempts=2)
+    coordinator.start()
+    try:
+        invocation = coordinator.submit("sleepcommand", ["5"])
+        for attempt in (1, 2):
+            worker = start_worker(commanders, coordinator.address, name=f"worker{attempt}")
+            wait_for(lambda: invocation.attempts == attempt and coordinator.workers.get(worker.name))
+            worker.stop()
+
+        with pytest.raises(RuntimeError, match="lost its worker 2 times"):
+            invocation.result(timeout=5)
+        assert list(invocation.stream(timeout=5)) == [RESTART]
+    finally:
+        coordinator.stop()
+
+
+def test_requeue_on_missed_heartbeat(commanders, coordinator):
+
+    silent = start_worker(commanders, coordinator.address, name="silent", heartbeat_interval=60)
+    beating = None
+    try:
+        wait_for(lambda: "silent" in coordinator.workers)
+        invocation = coordinator.submit("sleepcommand", ["3"])
+        assert invocation.worker == "silent"
+
+        beating = start_worker(commanders, coordinator.address, name="beating")
+
+        assert invocation.result(timeout=10) == 0
+        assert invocation.worker == "beating"
+        assert "silent" not in coordinator.workers
+    finally:
+        silent.stop()
+        if beating:
+            beating.stop()
+
+
+def connect_stuck_worker(address, name):
+    """Connects a worker that sends heartbeats but never reads."""
+    stuck = socket.create_connection(address)
+    hello = {"type": "hello", "worker": name, "commands": ["echocommand"]}
+    stuck.sendall((json.dumps(hello) + "\n").encode("utf-8"))
+
+    def heartbeat():
+        try:
+            while True:
+                stuck.sendall(b'{"type": "heartbeat"}\n')
+                time.sleep(0.1)
+        except OSError:
+            pass
+
+    threading.Thread(target=heartbeat, daemon=True).start()
+    return stuck
+
+
+def test_blocked_send_drops_worker(commanders, coordinator):
+
+    stuck = [connect_stuck_worker(coordinator.address, name) for name in ("first", "second")]
+    try:
+        wait_for(lambda: len(coordinator.workers) == 2)
+
+        started = time.monotonic()
+        invocation = coordinator.submit("echocommand", ["x" * 20_000_000])
+        assert time.monotonic() - started < 0.5
+
+        wait_for(lambda: invocation.attempts == 2 and not coordinator.workers)
+        assert not invocation.done
+        with pytest.raises(TimeoutError):
+            next(invocation.stream(timeout=0.1))
+    finally:
+        for sock in stuck:
+            sock.close()
+
+
+@pytest.mark.filterwarnings("error::pytest.PytestUnhandledThreadExceptionWarning")
+@pytest.mark.parametrize(
+    "messages",
+    [
+        [{"type": "hello", "capacity": 1}],
+        [[1]],
+        [{"type": "hello", "worker": "bad", "commands": ["echocommand"]}, [1]],
+        [{"type": "hello", "worker": "bad", "commands": ["echocommand"]}, {"type": "output"}],
+    ],
+)
+def test_malformed_messages_drop_worker(commanders, coordinator, messages):
+
+    bad = socket.create_connection(coordinator.address)
+    try:
+        for message in messages:
+            bad.sendall((json.dumps(message) + "\n").encode("utf-8"))
+
+        bad.settimeout(5)
+        while bad.recv(4096):
+            pass
+        assert "bad" not in coordinator.workers
+    finally:
+        bad.close()